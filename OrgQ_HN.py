@@ -22,14 +22,20 @@ from ij.measure import ResultsTable
 from ij.measure import Measurements
 from ij.process import ImageProcessor
 from ij.process import ImageConverter
+from ij.process import Blitter
+from ij.process import ByteProcessor
 from ij.plugin.frame import RoiManager
 from ij.plugin.filter import ParticleAnalyzer
 from ij.gui import GenericDialog
 from ij.gui import WaitForUserDialog
 from ij.plugin.filter import ThresholdToSelection
-from ij.plugin import ImageCalculator
-from ij.WindowManager import getCurrentImage
+from ij.plugin.filter import RankFilters
+from ij.plugin.filter import GaussianBlur
+from java.lang import Runtime, Thread
+from java.util.concurrent import Executors, Callable, ExecutionException, ThreadFactory
+from java.awt import Rectangle
 import xml.etree.ElementTree as ET
+from threading import Lock
 
 
 # To enable displayImages mode (such as for testing thresholds), make displayImages = True
@@ -38,6 +44,48 @@ displayImages = True
 #Enable using the wand tool to manually select the organoid ROI in cases where auto-threshold does not work
 enableWand = True
 
+# To process the images of a subfolder in parallel, make parallelImages = True
+# displayImages and enableWand are turned off in that mode since they wait on the user for every image
+parallelImages = False
+if parallelImages:
+    displayImages = False
+    enableWand = False
+
+# Half of the cores process images, the rest are left for ImageJ's own threads
+workers = max(1, Runtime.getRuntime().availableProcessors() // 2)
+
+# Creates daemon threads, so a pool can't keep running in Fiji after the macro ends (e.g. a cancelled dialog or an error)
+class DaemonThreadFactory(ThreadFactory):
+    def newThread(self, runnable):
+        thread = Thread(runnable)
+        thread.setDaemon(True)
+        return thread
+
+
+# Opens the channel images on background threads so the next image is decoded while the current one is processed
+openExecutor = Executors.newFixedThreadPool(workers if parallelImages else 1, DaemonThreadFactory())
+
+# The log file and the ParticleAnalyzer RoiManager setup are shared between images, so they are guarded when running in parallel
+logLock = Lock()
+particleAnalyzerLock = Lock()
+
+
+class ImageOpener(Callable):
+    def __init__(self, path):
+        self.path = path
+
+    def call(self):
+        return IJ.openImage(self.path)
+
+
+class ImageTask(Callable):
+    def __init__(self, subFolder, filename, pixel_length):
+        self.args = (subFolder, filename, pixel_length)
+
+    def call(self):
+        return process(*self.args)
+
+
 # Function to get the markers needed with a generic dialog for each subfolder, as well as the name of the output for that subfolder
 def getChannels(subFolder):
     gd = GenericDialog("Channel Options")
@@ -98,22 +146,108 @@ def getThresholds():
     return thresholds
 
 
+# Function to replace the old suffix at the end of a filename (e.g. _ch00.tif) with a new one
+
 def rreplace(s, old, new):
-    return (s[::-1].replace(old[::-1], new[::-1], 1))[::-1]
+    return s[:-len(old)] + new if s.endswith(old) else s
 
 
-############# Main loop, will run for every image. ##############
+# Function to convert an image to 8-bit, images that are already 8-bit are left as they are
+
+def toGray8(imp):
+    if imp.getBitDepth() != 8:
+        ImageConverter(imp).convertToGray8()
+
+
+# Function to measure a binary (0/255) mask inside a ROI from its histogram, which ImageJ computes in one Java-side pass.
+# Returns the number of positive (non-zero) pixels and the pixel count
+
+def measureRoi(ip, roi):
+    ip.setRoi(roi)
+    histogram = ip.getHistogram()
+    ip.resetRoi()
+
+    count = histogram[0] + histogram[255]
+    return histogram[255], count
+
+
+# Function to tell whether a particle is positive for a channel from its (positive pixels, pixels) pair.
+# Same as area fraction (in %) > threshold, without dividing
+
+def isPositive(areaFraction, threshold):
+    positive, count = areaFraction
+    return 100 * positive > threshold * count
+
+
+# Function to run the nuclei filters (Remove Outliers, Gaussian Blur, threshold) on the ch00 image tile by tile.
+# Every tile is cropped with a halo as wide as both filters reach, so the result is the same as filtering the whole image,
+# but each tile stays in cache across the filters instead of the whole image being streamed through memory once per filter.
+# For blur > 4.5 ImageJ downscales the image to blur it, which reaches further and depends on where the tile starts,
+# so the whole image is filtered as a single tile instead.
+# Returns a binary processor with the same foreground/background convention as Convert to Mask
+
+def filterNucleiTiled(ip, lowerBound, tileSize=512):
+    outlierRadius = 2
+    blurRadius = int(math.ceil(blur * math.sqrt(-2 * math.log(0.002)))) + 1
+    halo = outlierRadius + blurRadius
+
+    width = ip.getWidth()
+    height = ip.getHeight()
+    if blur > 4.5:
+        tileSize = max(width, height)
+    out = ByteProcessor(width, height)
+    rank = RankFilters()
+    gauss = GaussianBlur()
+
+    for ty in range(0, height, tileSize):
+        for tx in range(0, width, tileSize):
+            tw = min(tileSize, width - tx)
+            th = min(tileSize, height - ty)
+            x0 = max(tx - halo, 0)
+            y0 = max(ty - halo, 0)
+            x1 = min(tx + tw + halo, width)
+            y1 = min(ty + th + halo, height)
+
+            ip.setRoi(Rectangle(x0, y0, x1 - x0, y1 - y0))
+            tile = ip.crop()
+
+            rank.rank(tile, outlierRadius, RankFilters.OUTLIERS, RankFilters.DARK_OUTLIERS, 50)
+            gauss.blurGaussian(tile, blur)
+            tile.threshold(lowerBound - 1)
+
+            # Only the inside of the tile is kept, the halo was just there to feed the filters
+            tile.setRoi(Rectangle(tx - x0, ty - y0, tw, th))
+            out.insert(tile.crop(), tx, ty)
+
+    ip.resetRoi()
+    if not Prefs.blackBackground:
+        out.invertLut()
+    return out
+
+
+# Function to create a ParticleAnalyzer that adds its particles to roim.
+# ParticleAnalyzer.setRoiManager is static and only picked up by the next ParticleAnalyzer created, so both happen under a lock
+
+def createParticleAnalyzer(roim, options, measurements, table, minSize, maxSize, minCirc=0.0, maxCirc=1.0):
+    with particleAnalyzerLock:
+        ParticleAnalyzer.setRoiManager(roim)
+        pa = ParticleAnalyzer(options, measurements, table, minSize, maxSize, minCirc, maxCirc)
+    pa.setHideOutputImage(True)
+    return pa
 
-def process(subFolder, outputDirectory, filename):
-    #IJ.close()
-    imp = IJ.openImage(inputDirectory + subFolder + '/' + rreplace(filename, "_ch00.tif", ".tif"))
-    imp.show()
 
+# Finds the pixel length in microns from the xml metadata file of a folder (default 0.877017 if there is none).
+# The result is cached by folder since every image of an acquisition has the same pixel length
 
-    # Finds the pixel length in microns from the xml metadata file
-    file_list = [file for file in os.listdir(inputDirectory + subFolder) if file.endswith('.xml')]
+pixelLengths = {}
+
+def getPixelLength(folder):
+    if folder in pixelLengths:
+        return pixelLengths[folder]
+
+    file_list = [file for file in os.listdir(folder) if file.endswith('.xml')]
     if len(file_list) > 0:
-        xml = os.path.join(inputDirectory + subFolder, file_list[0])
+        xml = os.path.join(folder, file_list[0])
         element_tree = ET.parse(xml)
         root = element_tree.getroot()
         for dimensions in root.iter('DimensionDescription'):
@@ -126,12 +260,79 @@ def process(subFolder, outputDirectory, filename):
     else:
         pixel_length = 0.877017
 
-    log.write("Pixel Length:" + str(pixel_length) + "\n")
+    pixelLengths[folder] = pixel_length
+    return pixel_length
+
+
+# Function to get the columns of the output csv file for the channels of a subfolder
+
+def getFieldnames(channels):
+    fieldnames = ['Name', 'Directory', 'Image', 'size-average', tooBigKey, tooSmallKey, '#nuclei', 'all-negative']
+
+    # Adds the columns for each individual marker (ignoring Dapi since it was used to count nuclei)
+
+    fieldnames.append("organoid-area")
+
+    for chan in channels:
+        v, x = chan
+        fieldnames.append(v + "-positive")
+        fieldnames.append(v + "-intensity")
+        fieldnames.append(v + "-blobsarea")
+        fieldnames.append(v + "-blobsnuclei")
+
+    # Adds the column for colocalization between first and second marker
+
+    if len(channels) > 2:
+        fieldnames.append(k12)
+
+    # Adds the columns for colocalization between all three markers
+
+    if len(channels) > 3:
+        fieldnames.append(k13)
+        fieldnames.append(k23)
+        fieldnames.append(k123)
+
+    return fieldnames
+
+
+# Function to get the colocalization column names for the channels of a subfolder (None when there aren't enough channels).
+# They are built once per subfolder and used both for the csv columns and for every image's summary
+
+def getColocKeys(channels):
+    k12 = k13 = k23 = k123 = None
+
+    if len(channels) > 2:
+        k12 = channels[1][0] + '-' + channels[2][0] + '-positive'
+
+    if len(channels) > 3:
+        k13 = channels[1][0] + '-' + channels[3][0] + '-positive'
+        k23 = channels[2][0] + '-' + channels[3][0] + '-positive'
+        k123 = channels[1][0] + '-' + channels[2][0] + '-' + channels[3][0] + '-positive'
+
+    return k12, k13, k23, k123
+
+
+############# Main loop, will run for every image. ##############
+
+def process(subFolder, filename, pixel_length):
+    #IJ.close()
+
+    # Starts decoding the channel images right away, they are picked up once the mask is ready
+    pending = [None] * 5
+    for chan in channels:
+        v, x = chan
+        pending[x] = openExecutor.submit(ImageOpener(
+            inputDirectory + subFolder + '/' + rreplace(filename, "_ch00.tif", "_ch0" + str(x) + ".tif")))
+
+    imp = IJ.openImage(inputDirectory + subFolder + '/' + rreplace(filename, "_ch00.tif", ".tif"))
+    if not parallelImages:
+        imp.show()
+
+    # Arguments of Properties..., built once and used for both the merged and the ch00 image
+    props = "channels=1 slices=1 frames=1 unit=um pixel_width=%s pixel_height=%s voxel_depth=25400.0508001" % (pixel_length, pixel_length)
 
-    IJ.run(imp, "Properties...",
-           "channels=1 slices=1 frames=1 unit=um pixel_width=" + str(pixel_length) + " pixel_height=" + str(pixel_length) + " voxel_depth=25400.0508001")
-    ic = ImageConverter(imp);
-    ic.convertToGray8();
+    IJ.run(imp, "Properties...", props)
+    toGray8(imp)
     #IJ.setThreshold(imp, 2, 255)
 
 
@@ -144,23 +345,25 @@ def process(subFolder, outputDirectory, filename):
         WaitForUserDialog("Click on Organoid Area for it to be selected. Best selection will be at the edge of the organoid to get entire organoid shape.").show()
         IJ.run("Clear Outside")
 
+    # Uses its own hidden ROI manager so images processed in parallel don't share one
     if not enableWand:
         IJ.setAutoThreshold(imp, "Mean dark no-reset")
         IJ.run(imp, "Convert to Mask", "")
-        IJ.run(imp, "Analyze Particles...", "size=100000-Infinity add select")
-        rm = RoiManager.getInstance()
-        imp = getCurrentImage()
-        rm.select(imp, 0)
-        IJ.setBackgroundColor(0, 0, 0)
-        IJ.run(imp, "Clear Outside", "")
+        rm = RoiManager(True)
+        pa = createParticleAnalyzer(rm, ParticleAnalyzer.ADD_TO_MANAGER, Measurements.AREA, ResultsTable(),
+                                    100000 / (pixel_length * pixel_length), float('inf'))
+        pa.analyze(imp)
+        ip = imp.getProcessor()
+        ip.setColor(0)
+        ip.fillOutside(rm.getRoi(0))
 
     IJ.run(imp, "Convert to Mask", "")
     IJ.run(imp, "Remove Outliers...", "radius=5" + " threshold=50" + " which=Dark")
     IJ.run(imp, "Remove Outliers...", "radius=5" + " threshold=50" + " which=Bright")
 
-    # #Save the mask and open it
-    IJ.saveAs("tiff", inputDirectory + '/mask')
-    mask = IJ.openImage(inputDirectory + '/mask.tif')
+    # Keeps a copy of the mask in memory (the whole image, ignoring any selection)
+    mask = ImagePlus("mask", imp.getProcessor().duplicate())
+    mask.setCalibration(imp.getCalibration())
 
     if enableWand:
         #Select ROI again to add it to the the ROI manager so that intensities and area is saved
@@ -184,51 +387,45 @@ def process(subFolder, outputDirectory, filename):
 
     imp.close()
 
-    #Loop to open all the channel images
+    #Loop to collect all the channel images
     for chan in channels:
         v, x = chan
-        images[x] = IJ.openImage(
-            inputDirectory + subFolder + '/' + rreplace(filename, "_ch00.tif", "_ch0" + str(x) + ".tif"))
-
+        images[x] = pending[x].get()
 
         # Apply Mask on all the images and save them into an array
-        apply_mask = ImageCalculator()
-        images[x] = apply_mask.run("Multiply create 32 bit", mask, images[x])
-        ic = ImageConverter(images[x])
-        ic.convertToGray8()
+        # The mask is 0 outside the organoid and 255 inside, so an AND of the 8-bit images clears the outside in place
+        toGray8(images[x])
+        images[x].getProcessor().copyBits(mask.getProcessor(), 0, 0, Blitter.AND)
         imp = images[x]
 
         # Calculate the intensities for each channel as well as the organoid area
+        # getStats() measures the pixel count and mean inside the ROI in a single Java pass
+        ip = imp.getProcessor()
         for roi in rm.getRoisAsArray():
-            imp.setRoi(roi)
-            stats = imp.getStatistics(Measurements.MEAN | Measurements.AREA)
+            ip.setRoi(roi)
+            stats = ip.getStats()
+            ip.resetRoi()
             intensities[x] = stats.mean
-            bigAreas[x] = stats.area
+            bigAreas[x] = stats.pixelCount * pixel_length * pixel_length
 
     rm.close()
 
-    # Opens the ch00 image and sets default properties
-    apply_mask = ImageCalculator()
-    imp = IJ.openImage(inputDirectory + subFolder + '/' + filename)
-    imp = apply_mask.run("Multiply create 32 bit", mask, imp)
-    IJ.run(imp, "Properties...",
-           "channels=1 slices=1 frames=1 unit=um pixel_width=" + str(pixel_length) + " pixel_height=" + str(pixel_length) + " voxel_depth=25400.0508001")
+    # Copies the masked ch00 image (or opens it when ch00 isn't one of the channels) and sets default properties
+    if images[0] is not None:
+        imp = ImagePlus(filename, images[0].getProcessor().duplicate())
+    else:
+        imp = IJ.openImage(inputDirectory + subFolder + '/' + filename)
+        toGray8(imp)
+        imp.getProcessor().copyBits(mask.getProcessor(), 0, 0, Blitter.AND)
+    IJ.run(imp, "Properties...", props)
 
 
     # Sets the threshold and watersheds. for more details on image processing, see https://imagej.nih.gov/ij/developer/api/ij/process/ImageProcessor.html
 
-    ic = ImageConverter(imp);
-    ic.convertToGray8();
-
-    IJ.run(imp, "Remove Outliers...", "radius=2" + " threshold=50" + " which=Dark")
-
-    IJ.run(imp, "Gaussian Blur...", "sigma=" + str(blur))
-
-    IJ.setThreshold(imp, lowerBounds[0], 255)
+    imp.setProcessor(filterNucleiTiled(imp.getProcessor(), lowerBounds[0]))
 
     if displayImages:
         imp.show()
-    IJ.run(imp, "Convert to Mask", "")
     IJ.run(imp, "Watershed", "")
 
     if not displayImages:
@@ -239,9 +436,7 @@ def process(subFolder, outputDirectory, filename):
 
     table = ResultsTable()
     roim = RoiManager(True)
-    ParticleAnalyzer.setRoiManager(roim);
-    pa = ParticleAnalyzer(ParticleAnalyzer.ADD_TO_MANAGER, Measurements.AREA, table, 15, 9999999999999999, 0.2, 1.0)
-    pa.setHideOutputImage(True)
+    pa = createParticleAnalyzer(roim, ParticleAnalyzer.ADD_TO_MANAGER, Measurements.AREA, table, 15, 9999999999999999, 0.2, 1.0)
     # imp = impM
 
     # imp.getProcessor().invert()
@@ -249,21 +444,25 @@ def process(subFolder, outputDirectory, filename):
 
     areas = table.getColumn(0)
 
+    # Every particle is measured on the other channels since the blobs cover all of them, only the results are filtered:
+    # the particles within the size thresholds are used for the positive counts, the others are just counted as too big or too small
+
+    rois = roim.getRoisAsArray()
+    keep = [z for z, area in enumerate(areas) if tooSmallThreshold <= area <= tooBigThreshold]
+
     # This loop goes through the remaining channels for the other markers, by replacing the ch00 at the end with its corresponding channel
-    # It will save all the area fractions into a 2d array called areaFractionsArray
+    # It will save the area fractions of the kept particles into a 2d array called areaFractionsArray
+    # Each area fraction is kept as the pair (positive pixels, pixels), see isPositive()
+    # The positive flags of each channel (with the first threshold) are kept in positives for the kept particles
 
     areaFractionsArray = [None] * 5
+    positives = [None] * 5
     for chan in channels:
         v, x = chan
         # Opens each image and thresholds
 
+        # The channel images are already masked 8-bit images
         imp = images[x]
-
-        IJ.run(imp, "Properties...",
-               "channels=1 slices=1 frames=1 unit=um pixel_width=" + str(pixel_length) + " pixel_height=" + str(pixel_length) + " voxel_depth=25400.0508001")
-
-        ic = ImageConverter(imp);
-        ic.convertToGray8();
         IJ.setThreshold(imp, lowerBounds[x], 255)
 
 
@@ -274,45 +473,82 @@ def process(subFolder, outputDirectory, filename):
         IJ.run(imp, "Convert to Mask", "")
 
         # Measures the area fraction of the new image for each ROI from the ROI manager.
+        # After Convert to Mask the thresholded pixels are 255, so anything non-zero counts as positive
+        # The positive pixels inside the nuclei also give the blobs, so the channel doesn't need its own particle analysis
+        ip = imp.getProcessor()
         areaFractions = []
-        for roi in roim.getRoisAsArray():
-            imp.setRoi(roi)
-            stats = imp.getStatistics(Measurements.AREA_FRACTION)
-            areaFractions.append(stats.areaFraction)
+        blobs = []
+        for roi in rois:
+            positive, count = measureRoi(ip, roi)
+            areaFractions.append((positive, count))
+            blobs.append(positive * pixel_length * pixel_length)
+
+        flags = [isPositive(af, areaFractionThreshold[0]) for af in areaFractions]
+
+        blobsarea[x] = sum(blobs)
+        blobsnuclei[x] = sum(flags)
+
+        # Saves the results of the kept particles in areaFractionArray and positives
+
+        areaFractionsArray[x] = [areaFractions[z] for z in keep]
+        positives[x] = [flags[z] for z in keep]
 
-        # Saves the results in areaFractionArray
+        if not displayImages:
+            imp.changes = False
+            imp.close()
 
-        areaFractionsArray[x] = areaFractions
+        imp.close()
 
     roim.close()
 
+    # Logs every particle area. In parallel the name of the image goes in the same block so images don't interleave,
+    # one image at a time it was already logged before the image was processed
+
+    with logLock:
+        if parallelImages:
+            log.write("Processing: " + filename + " \n")
+        for area in areas:
+            log.write(str(area))
+            log.write("\n")
+
+    tooBig = sum(1 for area in areas if area > tooBigThreshold)
+    tooSmall = sum(1 for area in areas if area < tooSmallThreshold)
+    nuclei = len(keep)
+
+    # Calculate the average of the particles sizes
+
+    sizeAverage = 0
+    if nuclei > 0:
+        sizeAverage = round(sum(areas[z] for z in keep) / nuclei, 2)
+
+    # Counts the positive flags of each channel over the kept particles in one go
+
+    positiveCounts = [0] * 5
     for chan in channels:
         v, x = chan
+        positiveCounts[x] = sum(positives[x])
 
-        imp = images[x]
-        imp.deleteRoi()
-        roim = RoiManager(True)
-        ParticleAnalyzer.setRoiManager(roim);
-        pa = ParticleAnalyzer(ParticleAnalyzer.ADD_TO_MANAGER, Measurements.AREA, table, 15, 9999999999999999, 0.2, 1.0)
-        pa.analyze(imp)
-
-        blobs = []
-        for roi in roim.getRoisAsArray():
-            imp.setRoi(roi)
-            stats = imp.getStatistics(Measurements.AREA)
-            blobs.append(stats.area)
+    # A particle is all negative when none of the markers (ignoring Dapi) is positive
 
-        blobsarea[x] = sum(blobs) #take this out and use intial mask tissue area from the beginning
-        blobsnuclei[x] = len(blobs)
+    markers = [positives[x] for v, x in channels if x != 0]
+    if markers:
+        allNegative = sum(1 for flags in zip(*markers) if not any(flags))
+    else:
+        allNegative = nuclei
 
+    # Colocalization counts are the particles where every marker of the combination is above its own threshold
 
-        if not displayImages:
-            imp.changes = False
-            imp.close()
-        roim.reset()
-        roim.close()
+    if len(channels) > 2:
+        p1 = [isPositive(af, areaFractionThreshold[1]) for af in areaFractionsArray[1]]
+        p2 = [isPositive(af, areaFractionThreshold[2]) for af in areaFractionsArray[2]]
+        coloc12 = sum(1 for a, b in zip(p1, p2) if a and b)
 
-        imp.close()
+    if len(channels) > 3:
+        p3 = [isPositive(af, areaFractionThreshold[3]) for af in areaFractionsArray[3]]
+        p23 = [b and c for b, c in zip(p2, p3)]
+        coloc13 = sum(1 for a, c in zip(p1, p3) if a and c)
+        coloc23 = sum(p23)
+        coloc123 = sum(1 for a, bc in zip(p1, p23) if a and bc)
 
     # Creates the summary dictionary which will correspond to a single row in the output csv, with each key being a column
 
@@ -323,113 +559,42 @@ def process(subFolder, outputDirectory, filename):
 
     # Adds usual columns
 
-    summary['size-average'] = 0
-    summary['#nuclei'] = 0
-    summary['all-negative'] = 0
-
-    summary['too-big-(>' + str(tooBigThreshold) + ')'] = 0
-    summary['too-small-(<' + str(tooSmallThreshold) + ')'] = 0
-
-    # Creates the fieldnames variable needed to create the csv file at the end.
+    summary['size-average'] = sizeAverage
+    summary['#nuclei'] = nuclei
+    summary['all-negative'] = allNegative
 
-    fieldnames = ['Name', 'Directory', 'Image', 'size-average', 'too-big-(>' + str(tooBigThreshold) + ')',
-                  'too-small-(<' + str(tooSmallThreshold) + ')', '#nuclei', 'all-negative']
+    summary[tooBigKey] = tooBig
+    summary[tooSmallKey] = tooSmall
 
     # Adds the columns for each individual marker (ignoring Dapi since it was used to count nuclei)
 
     summary["organoid-area"] = bigAreas[x]
-    fieldnames.append("organoid-area")
 
     for chan in channels:
         v, x = chan
-        summary[v + "-positive"] = 0
-        fieldnames.append(v + "-positive")
-
+        summary[v + "-positive"] = positiveCounts[x]
         summary[v + "-intensity"] = intensities[x]
-        fieldnames.append(v + "-intensity")
-
         summary[v + "-blobsarea"] = blobsarea[x]
-        fieldnames.append(v + "-blobsarea")
-
         summary[v + "-blobsnuclei"] = blobsnuclei[x]
-        fieldnames.append(v + "-blobsnuclei")
 
     # Adds the column for colocalization between first and second marker
 
     if len(channels) > 2:
-        summary[channels[1][0] + '-' + channels[2][0] + '-positive'] = 0
-        fieldnames.append(channels[1][0] + '-' + channels[2][0] + '-positive')
+        summary[k12] = coloc12
 
     # Adds the columns for colocalization between all three markers
 
     if len(channels) > 3:
-        summary[channels[1][0] + '-' + channels[3][0] + '-positive'] = 0
-        summary[channels[2][0] + '-' + channels[3][0] + '-positive'] = 0
-        summary[channels[1][0] + '-' + channels[2][0] + '-' + channels[3][0] + '-positive'] = 0
-
-        fieldnames.append(channels[1][0] + '-' + channels[3][0] + '-positive')
-        fieldnames.append(channels[2][0] + '-' + channels[3][0] + '-positive')
-        fieldnames.append(channels[1][0] + '-' + channels[2][0] + '-' + channels[3][0] + '-positive')
+        summary[k13] = coloc13
+        summary[k23] = coloc23
+        summary[k123] = coloc123
 
-    # Loops through each particle and adds it to each field that it is True for.
+    # Closes the images when running one image at a time (in parallel nothing is shown and other images are still open)
 
-    areaCounter = 0
-    for z, area in enumerate(areas):
+    if not parallelImages:
+        IJ.run(imp, "Close All", "")
 
-        log.write(str(area))
-        log.write("\n")
-
-        if area > tooBigThreshold:
-            summary['too-big-(>' + str(tooBigThreshold) + ')'] += 1
-        elif area < tooSmallThreshold:
-            summary['too-small-(<' + str(tooSmallThreshold) + ')'] += 1
-        else:
-
-            summary['#nuclei'] += 1
-            areaCounter += area
-
-            temp = 0
-            for chan in channels:
-                v, x = chan
-                if areaFractionsArray[x][z] > areaFractionThreshold[
-                    0]:  # theres an error here im not sure why. i remember fixing it before
-                    summary[chan[0] + '-positive'] += 1
-                    if x != 0:
-                        temp += 1
-
-            if temp == 0:
-                summary['all-negative'] += 1
-
-            if len(channels) > 2:
-                if areaFractionsArray[1][z] > areaFractionThreshold[1]:
-                    if areaFractionsArray[2][z] > areaFractionThreshold[2]:
-                        summary[channels[1][0] + '-' + channels[2][0] + '-positive'] += 1
-
-            if len(channels) > 3:
-                if areaFractionsArray[1][z] > areaFractionThreshold[1]:
-                    if areaFractionsArray[3][z] > areaFractionThreshold[3]:
-                        summary[channels[1][0] + '-' + channels[3][0] + '-positive'] += 1
-                if areaFractionsArray[2][z] > areaFractionThreshold[2]:
-                    if areaFractionsArray[3][z] > areaFractionThreshold[3]:
-                        summary[channels[2][0] + '-' + channels[3][0] + '-positive'] += 1
-                        if areaFractionsArray[1][z] > areaFractionThreshold[1]:
-                            summary[channels[1][0] + '-' + channels[2][0] + '-' + channels[3][0] + '-positive'] += 1
-
-    # Calculate the average of the particles sizes
-
-    if float(summary['#nuclei']) > 0:
-        summary['size-average'] = round(areaCounter / summary['#nuclei'], 2)
-
-    # Opens and appends one line on the final csv file for the subfolder (remember that this is still inside the loop that goes through each image)
-
-    with open(outputDirectory + "/" + outputName + ".csv", 'a') as csvfile:
-
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore', lineterminator='\n')
-        if os.path.getsize(outputDirectory + "/" + outputName + ".csv") < 1:
-            writer.writeheader()
-        writer.writerow(summary)
-
-    IJ.run(imp, "Close All", "")
+    return summary
 
 ########################## code begins running here ##############################
 
@@ -470,6 +635,11 @@ with open(outputDirectory + "log.txt", "w") as log:
     tooBigThreshold = 500
     blur = 1
 
+    # Column names that depend on the thresholds, built once for all the images
+
+    tooBigKey = 'too-big-(>' + str(tooBigThreshold) + ')'
+    tooSmallKey = 'too-small-(<' + str(tooSmallThreshold) + ')'
+
     log.write("________________________\n")
     log.write("Default calculation thresholds: \n")
     log.write("	areaFractionThreshold:" + str(areaFractionThreshold) + "\n")
@@ -508,7 +678,6 @@ with open(outputDirectory + "log.txt", "w") as log:
         log.write("Channels: " + str(channels) + "\n")
         log.write("Output Name: " + outputName + "\n")
 
-        open(outputDirectory + "/" + outputName + ".csv", 'w').close
         lowerBounds = [40, 20, 35, 50, 40]
         for chan in channels:
             v, x = chan
@@ -517,15 +686,44 @@ with open(outputDirectory + "log.txt", "w") as log:
 
         log.write("Lower Bound Thresholds: " + str(lowerBounds) + "\n")
 
+        k12, k13, k23, k123 = getColocKeys(channels)
+
+        pixel_length = getPixelLength(inputDirectory + subFolder)
+        log.write("Pixel Length:" + str(pixel_length) + "\n")
+
         # Finds all correct EVOS split channel ch0 files and runs through them one at a time (see main loop process() on top)
 
         log.write("_________________________\n")
         log.write("Begining loop for each image \n")
 
-        for filename in os.listdir(inputDirectory + subFolder):
-            if filename.endswith("ch00.tif"):
-                log.write("Processing: " + filename + " \n")
-                process(subFolder, outputDirectory, filename);
+        # The csv file is opened once for the subfolder and every image appends its row through the same writer
+
+        with open(outputDirectory + "/" + outputName + ".csv", 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=getFieldnames(channels), extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+
+            filenames = [filename for filename in os.listdir(inputDirectory + subFolder) if filename.endswith("ch00.tif")]
+
+            # In parallel, the summaries are collected from the futures in file order so only this thread writes the csv file
+            # An image that fails is logged and left out of the csv file, and the pool is always stopped so no task keeps running
+            if parallelImages:
+                pool = Executors.newFixedThreadPool(workers)
+                try:
+                    futures = []
+                    for filename in filenames:
+                        futures.append((filename, pool.submit(ImageTask(subFolder, filename, pixel_length))))
+                    for filename, future in futures:
+                        try:
+                            writer.writerow(future.get())
+                        except ExecutionException as e:
+                            with logLock:
+                                log.write("Failed: " + filename + " (" + str(e.getCause()) + ") \n")
+                finally:
+                    pool.shutdownNow()
+            else:
+                for filename in filenames:
+                    log.write("Processing: " + filename + " \n")
+                    writer.writerow(process(subFolder, filename, pixel_length))
         log.write("_________________________\n")
         log.write("Completed subfolder " + subFolder + ".  \n")
         log.write("\n")
@@ -539,4 +737,6 @@ with open(outputDirectory + "log.txt", "w") as log:
 
     log.write(cat)
 
+openExecutor.shutdown()
+
 print(cat)